@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+import pytest
+from nltk.translate.bleu_score import SmoothingFunction, sentence_bleu
+
+from utils_metrics import SMOOTHING_METHODS, bleu_statistics, sentence_bleu_from_stats, sentence_bleu_scores
+
+REF_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'images', 'ref.txt')
+
+# The weightings translation-metrics.py scores together, plus short ones.
+WEIGHTINGS = [(1, 0, 0, 0), (0.5, 0.5, 0, 0), (1 / 3, 1 / 3, 1 / 3), (0.25,) * 4, (0.1,) * 10, (1,), (0.5, 0.5)]
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    with open(REF_FILE) as lines:
+        sentences = [next(lines).split() for _ in range(101)]
+    refs = sentences[:100]
+    # Half of each hypothesis comes from the next sentence, half from its reference.
+    hyps = [hyp[: len(hyp) // 2] + ref[len(ref) // 2 :] for hyp, ref in zip(sentences[1:], refs)]
+    return refs, hyps, bleu_statistics([[ref] for ref in refs], hyps, 10)
+
+
+@pytest.mark.parametrize('method', SMOOTHING_METHODS)
+def test_batched_weightings_match_nltk(corpus, method):
+    refs, hyps, stats = corpus
+    scores = sentence_bleu_from_stats(stats, WEIGHTINGS, method)
+    smoothing_function = getattr(SmoothingFunction(), 'method%d' % method)
+    for i, (ref, hyp) in enumerate(zip(refs, hyps)):
+        for k, weights in enumerate(WEIGHTINGS):
+            try:
+                expected = sentence_bleu([ref], hyp, weights=weights, smoothing_function=smoothing_function)
+            except (AssertionError, IndexError, ZeroDivisionError):
+                # nltk rejects method 6 on short weightings or zero trigram precision.
+                continue
+            assert scores[i, k] == pytest.approx(expected, rel=1e-12, abs=1e-300)
+
+
+@pytest.mark.parametrize('method', SMOOTHING_METHODS)
+def test_batched_weightings_match_single(corpus, method):
+    _, _, stats = corpus
+    scores = sentence_bleu_from_stats(stats, WEIGHTINGS, method)
+    for k, weights in enumerate(WEIGHTINGS):
+        np.testing.assert_allclose(scores[:, k], sentence_bleu_from_stats(stats, weights, method), rtol=1e-12)
+
+
+@pytest.mark.parametrize('method', SMOOTHING_METHODS)
+def test_sentence_bleu_scores_short_weightings(corpus, method):
+    refs, hyps, _ = corpus
+    smoothing_function = getattr(SmoothingFunction(), 'method%d' % method)
+    weights_list = [(1,), (0.5, 0.5)]
+    scores = sentence_bleu_scores([refs[0]], hyps[0], weights_list, method)
+    for score, weights in zip(scores, weights_list):
+        try:
+            expected = sentence_bleu([refs[0]], hyps[0], weights=weights, smoothing_function=smoothing_function)
+        except (AssertionError, IndexError, ZeroDivisionError):
+            continue
+        assert score == pytest.approx(expected, rel=1e-12)
@@ -0,0 +1,39 @@
+import os
+import random
+
+import pytest
+
+from utils_metrics import ter, ter_edits
+
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'images')
+
+
+def test_equal_gain_shifts_break_ties_on_tokens():
+    # Two shifts reduce the edit distance equally; the one giving the larger
+    # shifted hypothesis, compared as strings, is taken first.
+    hyp = 'd b e e e d c e e c a'.split()
+    ref = 'd c c e b e b b c d c a'.split()
+    assert ter(hyp, ref) == 7 / 12
+
+
+def _random_pairs(count, seed=0):
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(count):
+        hyp = rng.choices('abcdef', k=rng.randint(0, 15))
+        ref = rng.choices('abcdef', k=rng.randint(0, 15))
+        pairs.append((hyp, ref))
+    return pairs
+
+
+def _corpus_pairs(count):
+    with open(os.path.join(IMAGES_DIR, 'ref.txt')) as refs, open(os.path.join(IMAGES_DIR, '10.txt')) as hyps:
+        return [(hyp.split(), ref.split()) for hyp, ref, _ in zip(hyps, refs, range(count))]
+
+
+@pytest.mark.parametrize('pairs', [_random_pairs(400), _corpus_pairs(100)], ids=['random', 'images'])
+def test_tercom_edits_match_sacrebleu(pairs):
+    lib_ter = pytest.importorskip('sacrebleu.metrics.lib_ter')
+    for hyp, ref in pairs:
+        expected, _ = lib_ter.translation_edit_rate(hyp, ref)
+        assert ter_edits(hyp, ref, tercom=True) == expected, (hyp, ref)
@@ -4,15 +4,22 @@
 import argparse
 import json
 import nltk
-from nltk.translate.bleu_score import sentence_bleu
-import numpy as np
 from rouge import FilesRouge
-#from sari import corpus_sari
+from utils_metrics import SMOOTHING_METHODS, bleu_statistics, compute_rouge_n, corpus_bleu_from_stats, corpus_cer, corpus_ter, corpus_wer, sentence_bleu_from_stats, write_edit_traces
+from sari import corpus_sari
 
 '''
-TER in Bash script (NMT repo) only, also find there 1-4Gram BLEU
+1-4Gram BLEU, TER and WER are computed here from the same tokens, CER from the raw lines
 '''
 
+BLEU_WEIGHTS = {
+    'BLEU-1': (1,0,0,0),
+    'BLEU-2': (0.5,0.5,0,0),
+    'BLEU-3': (1/3,1/3,1/3),
+    'BLEU-4': (0.25,0.25,0.25,0.25),
+    'BLEU-10': (0.1,0.1,0.1,0.1,0.1,0.1,0.1,0.1,0.1,0.1),
+}
+
 def tokenise(reference_corpus,generated_corpus,reftokens,hyptokens):
     '''
     reference_corpus = filepath to reference corpus
@@ -27,40 +34,49 @@ def tokenise(reference_corpus,generated_corpus,reftokens,hyptokens):
             hyptokens.append(nltk.word_tokenize(line))
     return (reftokens,hyptokens)
 
-def bleu(args,reftokens,hyptokens,outmetrics,introfile,generated_corpus):
+def parse_weights(config):
+    '''
+    config = comma-separated n-gram weights from the command line, e.g. '0.5,0.3,0.2'
+    '''
+    return tuple(float(weight) for weight in config.split(','))
+
+def parse_smoothing(config):
+    '''
+    config = comma-separated Chen & Cherry smoothing methods from the command line, e.g. '0,3,7', or 'all'
+    '''
+    if config == 'all':
+        return list(SMOOTHING_METHODS)
+    return [int(method) for method in config.split(',')]
+
+def bleu(args,reftokens,hyptokens,outmetrics,introfile,generated_corpus,weights=None):
     '''
     reftokens = pre-processing tokens from the reference transcription to be passed to BLEU
     hyptokens = pre-processing tokens from the hypothesis transcription to be passed to BLEU
-    outmetrics = dictionary to write scores to
-    '''
-    score_list_one = np.zeros(shape=(len(hyptokens)))
-    score_list_two = np.zeros(shape=(len(hyptokens)))
-    score_list_three = np.zeros(shape=(len(hyptokens)))
-    score_list_four = np.zeros(shape=(len(hyptokens)))
-    score_list_ten = np.zeros(shape=(len(hyptokens)))
-    cnt = 0
-    for refs,hyps in zip(reftokens,hyptokens):
-        score_one = sentence_bleu([refs],hyps,weights=(1,0,0,0))
-        score_list_one[cnt] = score_one
-        score_two = sentence_bleu([refs],hyps,weights=(0.5,0.5,0,0))
-        score_list_two[cnt] = score_two
-        score_three = sentence_bleu([refs],hyps,weights=(0.33,0.33,0.33,0.33))
-        score_list_three[cnt] = score_three
-        score_four = sentence_bleu([refs],hyps,weights=(0.25,0.25,0.25,0.25))
-        score_list_four[cnt] = score_four
-        score_ten = sentence_bleu([refs],hyps,weights=(0.1,0.1,0.1,0.1,0.1,0.1,0.1,0.1,0.1,0.1))
-        score_list_ten[cnt] = score_ten
-        cnt += 1
-
-    score_list_mean = np.mean([score_list_one,score_list_three,score_list_two,score_list_four],axis=0)
+    outmetrics = dictionary to write scores to, both as the mean sentence BLEU and as corpus BLEU ('corpus-' prefix)
+    weights = dictionary of extra BLEU names and weight tuples, scored alongside BLEU_WEIGHTS and any --weights
+    unsmoothed scores are always written; smoothed scores (--smoothing other than 0) are added with a '-smooth<method>' suffix
+    '''
+    weightings = dict(BLEU_WEIGHTS)
+    for config in args.weights or []:
+        weightings['BLEU-' + config] = parse_weights(config)
+    weightings.update(weights or {})
+    names = list(weightings)
+    methods = [0] + [method for method in parse_smoothing(args.smoothing or '0') if method != 0]
+
+    # smoothing methods 5 and 7 also use the 5-gram precision, as nltk does
+    max_order = max([5] + [len(weighting) for weighting in weightings.values()])
+    stats = bleu_statistics([[refs] for refs in reftokens],hyptokens,max_order)
+    scores = sentence_bleu_from_stats(stats,list(weightings.values()),methods)
+    corpus_scores = corpus_bleu_from_stats(stats,list(weightings.values()),methods)
+
+    score_list_mean = scores[0][:,[names.index(name) for name in ('BLEU-1','BLEU-2','BLEU-3','BLEU-4')]].mean(axis=1)
     print(score_list_mean)
 
-#    print('\n\n\n 1-GRAM = ',score_list_one.mean(),'\n\n')
-    outmetrics['BLEU-1'] = score_list_one.mean()
-    outmetrics['BLEU-2'] = score_list_two.mean()
-    outmetrics['BLEU-3'] = score_list_three.mean()
-    outmetrics['BLEU-4'] = score_list_four.mean()
-    outmetrics['BLEU-10'] = score_list_ten.mean()
+    for method,method_scores,method_corpus_scores in zip(methods,scores,corpus_scores):
+        suffix = '-smooth%d' % method if method else ''
+        for name,score_list,corpus_score in zip(names,method_scores.T,method_corpus_scores):
+            outmetrics[name + suffix] = score_list.mean()
+            outmetrics['corpus-' + name + suffix] = corpus_score
 
     if args.verbose:
         with open(introfile, 'w') as sents, open(generated_corpus, 'r') as cleanlines:
@@ -80,17 +96,72 @@ def bleu(args,reftokens,hyptokens,outmetrics,introfile,generated_corpus):
 #            sents.append(item,ticker,score_list_one)
 #    return(score_list_one)
 
-def rouge(reference_corpus,generated_corpus):
+def ter(args,reftokens,hyptokens,outmetrics):
+    '''
+    reftokens = pre-processing tokens from the reference transcription, as passed to BLEU
+    hyptokens = pre-processing tokens from the hypothesis transcription, as passed to BLEU
+    outmetrics = dictionary to write corpus TER (total edits / total reference length) to, with per-sentence TER under 'sentence-TER'
+    with --traces, the edit operations of every sentence are written to <traces>-ter.npz
+    '''
+    processes = args.processes or None
+    if args.traces:
+        corpus_score,sentence_scores,traces = corpus_ter(hyptokens,reftokens,processes,bool(args.tercom),trace=True)
+        write_edit_traces(args.traces + '-ter.npz',traces)
+    else:
+        corpus_score,sentence_scores = corpus_ter(hyptokens,reftokens,processes,bool(args.tercom))
+    outmetrics['TER'] = corpus_score
+    outmetrics['sentence-TER'] = sentence_scores.tolist()
+
+def errorrates(args,reference_corpus,generated_corpus,reftokens,hyptokens,outmetrics):
+    '''
+    reference_corpus = filepath to reference corpus, read again for character error rate
+    generated corpus = filepath to generated corpus (either simplified or translated)
+    reftokens = pre-processing tokens from the reference transcription, as passed to BLEU
+    hyptokens = pre-processing tokens from the hypothesis transcription, as passed to BLEU
+    outmetrics = dictionary to write corpus WER and CER to, with per-sentence rates under 'sentence-WER' and 'sentence-CER'
+    with --traces, the word edit operations of every sentence are written to <traces>-wer.npz
+    '''
+    if args.traces:
+        corpus_score,sentence_scores,traces = corpus_wer(hyptokens,reftokens,trace=True)
+        write_edit_traces(args.traces + '-wer.npz',traces)
+    else:
+        corpus_score,sentence_scores = corpus_wer(hyptokens,reftokens)
+    outmetrics['WER'] = corpus_score
+    outmetrics['sentence-WER'] = sentence_scores.tolist()
+
+    with open(reference_corpus,'r') as refs, open(generated_corpus,'r') as hyps:
+        reflines = [line.rstrip('\n') for line in refs]
+        hyplines = [line.rstrip('\n') for line in hyps]
+    corpus_score,sentence_scores = corpus_cer(hyplines,reflines)
+    outmetrics['CER'] = corpus_score
+    outmetrics['sentence-CER'] = sentence_scores.tolist()
+
+def rouge(reference_corpus,generated_corpus,reftokens,hyptokens,outmetrics):
+    '''
+    reftokens = pre-processing tokens from the reference transcription, as passed to BLEU
+    hyptokens = pre-processing tokens from the hypothesis transcription, as passed to BLEU
+    outmetrics = dictionary to write the mean clipped ROUGE-1 and ROUGE-2 recall ('r'), precision ('p') and F1 ('f') to, as 'ROUGE-1-clipped' and 'ROUGE-2-clipped'
+    the printed ROUGE-1/2/L come from the rouge package, which counts each distinct n-gram once; the clipped scores count repeated n-grams up to their count in the reference, so they differ
+    '''
+    for n in (1,2):
+        recall,precision,f1 = compute_rouge_n(reftokens,hyptokens,n)
+        outmetrics['ROUGE-%d-clipped' % n] = {'r':recall.mean(),'p':precision.mean(),'f':f1.mean()}
     fr = FilesRouge()
     scores = fr.get_scores(reference_corpus,generated_corpus)
     print(scores,'\n\n\n')
 
-def dosari(orig_sents,sys_sents,ref_sents):
+def dosari(system_corpus,generated_corpus,reference_corpus,outmetrics):
     '''
-    Import SARI.py functionality to here, append score to dict
+    system_corpus = filepath to the original (complex) sentences the generated corpus simplifies
+    generated corpus = filepath to generated corpus (simplified)
+    reference_corpus = filepath to reference corpus, used as the single SARI reference
+    outmetrics = dictionary to write corpus SARI to
     '''
-    
-#    score = corpus_sari(orig_sents,sys_sents,ref_sents)
+    with open(system_corpus,'r') as origs, open(generated_corpus,'r') as hyps, open(reference_corpus,'r') as refs:
+        orig_sents = [line.rstrip('\n') for line in origs]
+        sys_sents = [line.rstrip('\n') for line in hyps]
+        ref_sents = [line.rstrip('\n') for line in refs]
+    outmetrics['SARI'] = corpus_sari(orig_sents,sys_sents,[ref_sents])
 
 def tojson(args,output_file,outmetrics):
     '''
@@ -109,15 +180,20 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-r',"--ref",help="Path to input text file containing reference text from your model")
     parser.add_argument('-g',"--gen",help="Path to input text file containing generated text from your model")
-    parser.add_argument('-s',"--sys",help="Path to input text file containing system text from your model, for simplification only")
-    parser.add_argument('-rg',"--rouge",help="If specified, outputs ROUGE scores. Run by specifying '--rouge=True'")
+    parser.add_argument('-s',"--sys",help="Path to input text file containing the original sentences your model simplified, for simplification only. Enables SARI")
+    parser.add_argument('-rg',"--rouge",help="If specified, prints the rouge package's ROUGE scores and writes clipped-count ROUGE-1/2 as 'ROUGE-n-clipped'. Run by specifying '--rouge=True'")
     parser.add_argument('-v',"--verbose",help="verbose to do analysis. Run by specifying --verbose=True or -v 1")
+    parser.add_argument('-w',"--weights",action='append',help="Extra BLEU weighting as comma-separated n-gram weights, e.g. -w 0.5,0.3,0.2. Can be repeated")
+    parser.add_argument('-sm',"--smoothing",help="Chen & Cherry smoothing methods for BLEU, comma-separated from 0 (none, the default) to 7, or 'all'")
+    parser.add_argument('-tc',"--tercom",help="If specified, TER uses tercom's shift limits and matches sacrebleu (case-sensitive). Run by specifying '--tercom=True'")
+    parser.add_argument('-p',"--processes",type=int,default=1,help="Number of processes to compute TER on, 0 for one per CPU. Defaults to 1")
+    parser.add_argument('-et',"--traces",help="Path prefix to write TER and WER edit operations of every sentence to, as <traces>-ter.npz and <traces>-wer.npz")
     parser.add_argument('-o',"--out",help="Path to output file")
     args = parser.parse_args()
 
     reference_corpus = args.ref
     generated_corpus = args.gen
-#    system_corpus = args.sys
+    system_corpus = args.sys
     output_file = args.out
     introfile = 'view-sents.txt'
 
@@ -127,9 +203,13 @@ def main():
 
     tokenise(reference_corpus,generated_corpus,reftokens,hyptokens)
     bleu(args,reftokens,hyptokens,outmetrics,introfile,generated_corpus)
+    ter(args,reftokens,hyptokens,outmetrics)
+    errorrates(args,reference_corpus,generated_corpus,reftokens,hyptokens,outmetrics)
+    if system_corpus:
+        dosari(system_corpus,generated_corpus,reference_corpus,outmetrics)
 
     if args.rouge:
-        rouge(reference_corpus,generated_corpus)
+        rouge(reference_corpus,generated_corpus,reftokens,hyptokens,outmetrics)
     tojson(args,output_file,outmetrics)
 
 if __name__ == '__main__':
@@ -22,6 +22,497 @@ evaluation metrics for machine translation. COLING 2004.
 
 import collections
 import math
+import sys
+
+import numpy as np
+
+
+_COLLISION_MESSAGE = "Two different n-grams share a 64-bit key"
+
+
+class NgramTable(collections.namedtuple(
+    "NgramTable", ["hashes", "segments", "counts", "checks"])):
+  """N-gram counts of one or more segments, kept as sorted hash arrays.
+  hashes holds, in ascending order, the key of every distinct n-gram salted
+  with the index of its segment; segments and counts hold that segment index
+  and the count of the n-gram. checks holds a second hash of each n-gram when
+  collisions are checked, and is None otherwise. Tables of several segments
+  are combined and compared with a single sort or searchsorted, rather than
+  with one Counter operation per segment.
+  """
+  __slots__ = ()
+
+
+_SEGMENT_SALT = np.uint64(0xd6e8feb86659fd93)
+
+
+def _group_table(hashes, segments, counts, checks, reduce):
+  """Builds a table, combining the counts of equal hashes with reduce."""
+  order = np.argsort(hashes, kind="stable")
+  hashes, segments, counts = hashes[order], segments[order], counts[order]
+  same = hashes[1:] == hashes[:-1]
+  clash = segments[1:] != segments[:-1]
+  if checks is not None:
+    checks = checks[order]
+    clash |= checks[1:] != checks[:-1]
+  if np.any(same & clash):
+    raise ValueError(_COLLISION_MESSAGE)
+  first = np.ones(len(hashes[:1]), dtype=bool)
+  starts = np.flatnonzero(np.concatenate([first, ~same]))
+  if len(counts):
+    counts = reduce.reduceat(counts, starts)
+  return NgramTable(hashes[starts], segments[starts], counts,
+                    None if checks is None else checks[starts])
+
+
+def ngram_table(keys, segments=None, checks=None):
+  """Counts n-gram keys into an NgramTable.
+  Args:
+    keys: uint64 array of n-gram keys, as hashed by NgramVocabulary.
+    segments: index of the segment each key comes from. All keys belong to
+        segment 0 if not given.
+    checks: optional second hashes of the n-grams, to detect collisions.
+  Returns:
+    NgramTable with one entry per distinct n-gram of each segment.
+  """
+  if segments is None:
+    segments = np.zeros(len(keys), dtype=np.int64)
+  hashes = keys + segments.astype(np.uint64) * _SEGMENT_SALT
+  return _group_table(hashes, segments, np.ones(len(keys), dtype=np.int64),
+                      checks, np.add)
+
+
+def _merge_tables(tables, reduce):
+  checks = [table.checks for table in tables]
+  return _group_table(
+      np.concatenate([table.hashes for table in tables]),
+      np.concatenate([table.segments for table in tables]),
+      np.concatenate([table.counts for table in tables]),
+      None if any(c is None for c in checks) else np.concatenate(checks),
+      reduce)
+
+
+def table_sum(*tables):
+  """Union of tables, adding counts like Counter +."""
+  return _merge_tables(tables, np.add)
+
+
+def table_max(*tables):
+  """Union of tables, keeping the largest count like Counter |."""
+  return _merge_tables(tables, np.maximum)
+
+
+def table_lookup(table, other):
+  """Returns the count in other of every entry of table, 0 where absent."""
+  if not len(other.hashes):
+    return np.zeros(len(table.hashes), dtype=np.int64)
+  index = np.minimum(np.searchsorted(other.hashes, table.hashes),
+                     len(other.hashes) - 1)
+  found = other.hashes[index] == table.hashes
+  clash = other.segments[index] != table.segments
+  if table.checks is not None and other.checks is not None:
+    clash |= other.checks[index] != table.checks
+  if np.any(found & clash):
+    raise ValueError(_COLLISION_MESSAGE)
+  return np.where(found, other.counts[index], 0)
+
+
+def _with_counts(table, counts):
+  """Entries of table with new counts, dropping those no longer positive."""
+  keep = counts > 0
+  return NgramTable(table.hashes[keep], table.segments[keep], counts[keep],
+                    None if table.checks is None else table.checks[keep])
+
+
+def table_intersection(table, other):
+  """Clipped intersection of two tables, like Counter &."""
+  return _with_counts(table, np.minimum(table.counts,
+                                        table_lookup(table, other)))
+
+
+def table_difference(table, other):
+  """Clipped difference of two tables, like Counter -."""
+  return _with_counts(table, table.counts - table_lookup(table, other))
+
+
+def table_scale(table, factor):
+  """Table with every count multiplied by factor."""
+  return table._replace(counts=table.counts * factor)
+
+
+def table_segment_totals(table, num_segments):
+  """Sum of the counts of each segment, as an integer array."""
+  return np.bincount(table.segments, weights=table.counts,
+                     minlength=num_segments).astype(np.int64)
+
+
+class NgramVocabulary(object):
+  """Interns tokens to integer ids and keys n-grams by 64-bit rolling hashes.
+  The keys of every n-gram order are computed incrementally from the token
+  ids with NumPy, so no tuple or string is built per n-gram. Keys are only
+  comparable between segments keyed by the same vocabulary. Unless
+  check_collisions is False, the tables of corpus_ngram_tables carry a second
+  independent hash of each n-gram, and a ValueError is raised if two
+  different n-grams are found to share a key whenever tables are combined or
+  compared.
+  """
+
+  _BASE = np.uint64(0x100000001b3)
+  _CHECK_BASE = np.uint64(0x9e3779b97f4a7c15)
+
+  def __init__(self, check_collisions=True):
+    self._ids = {}
+    self.check_collisions = check_collisions
+
+  def __len__(self):
+    return len(self._ids)
+
+  def encode(self, segment):
+    """Returns the ids of the tokens in segment, interning unseen tokens."""
+    ids = self._ids
+    return np.fromiter((ids.setdefault(token, len(ids)) for token in segment),
+                       dtype=np.uint64, count=len(segment))
+
+  @staticmethod
+  def _rolling_hashes(ids, max_order, base):
+    hashes = []
+    ngram_hashes = np.zeros(len(ids) + 1, dtype=np.uint64)
+    for order in range(1, max_order + 1):
+      ngram_hashes = ngram_hashes[:-1] * base + ids[order-1:]
+      hashes.append(ngram_hashes)
+    return hashes
+
+  def corpus_ngram_tables(self, corpus, max_order, segments=None):
+    """Counts the n-grams of every segment of a tokenized corpus at once.
+    The whole corpus is hashed as one token array; n-grams that would cross
+    from one segment into the next are dropped.
+    Args:
+      corpus: list of segments, each a list of tokens.
+      max_order: maximum length in tokens of the n-grams counted.
+      segments: segment index to record for each entry of corpus. Defaults
+          to the position of the entry in corpus.
+    Returns:
+      List of max_order NgramTables, entry n-1 holding the n-grams of order n.
+    """
+    lengths = np.array([len(segment) for segment in corpus], dtype=np.int64)
+    if segments is None:
+      segments = np.arange(len(corpus))
+    ids = self.encode([token for segment in corpus for token in segment])
+    ids += np.uint64(1)
+    token_segments = np.repeat(np.asarray(segments, dtype=np.int64), lengths)
+    ends = np.repeat(np.cumsum(lengths), lengths)
+    tokens_left = ends - np.arange(len(ids))
+    keys = self._rolling_hashes(ids, max_order, self._BASE)
+    if self.check_collisions:
+      checks = self._rolling_hashes(ids, max_order, self._CHECK_BASE)
+    else:
+      checks = [None] * max_order
+    tables = []
+    for order, order_keys, order_checks in zip(range(1, max_order + 1), keys,
+                                               checks):
+      valid = tokens_left[:len(order_keys)] >= order
+      tables.append(ngram_table(
+          order_keys[valid], token_segments[:len(order_keys)][valid],
+          None if order_checks is None else order_checks[valid]))
+    return tables
+
+
+class PreparedReferences(object):
+  """Reference side of a corpus, prepared once for scoring many systems.
+  Holds, for every n-gram order, an NgramTable with the maximum count of each
+  reference n-gram of a segment over all of its references, and the lengths
+  of those references. Scoring a translation corpus against it only extracts
+  the hypothesis n-grams.
+  Args:
+    reference_corpus: list of lists of references for each translation. Each
+        reference should be tokenized into a list of tokens.
+    max_order: highest n-gram order to prepare.
+    vocab: NgramVocabulary used to key the n-grams. A new one is created if
+        not given.
+  """
+
+  def __init__(self, reference_corpus, max_order=4, vocab=None):
+    if any(len(references) == 0 for references in reference_corpus):
+      raise ValueError("Every segment needs at least one reference")
+    self.max_order = max_order
+    self.vocab = NgramVocabulary() if vocab is None else vocab
+    max_refs = max((len(references) for references in reference_corpus),
+                   default=1)
+    ref_tables = []
+    for j in range(max_refs):
+      owners = [i for i, references in enumerate(reference_corpus)
+                if len(references) > j]
+      ref_tables.append(self.vocab.corpus_ngram_tables(
+          [reference_corpus[i][j] for i in owners], max_order, owners))
+    self.tables = [table_max(*tables) for tables in zip(*ref_tables)]
+
+    num_refs = np.array([len(references) for references in reference_corpus],
+                        dtype=np.int64)
+    self._ref_starts = np.cumsum(num_refs) - num_refs
+    self._ref_owners = np.repeat(np.arange(len(num_refs)), num_refs)
+    self.ref_lengths = np.array([len(r) for references in reference_corpus
+                                 for r in references], dtype=np.int64)
+
+  def __len__(self):
+    return len(self._ref_starts)
+
+  def shortest_ref_lengths(self):
+    """Length of the shortest reference of every segment."""
+    if not len(self):
+      return np.zeros(0, dtype=np.int64)
+    return np.minimum.reduceat(self.ref_lengths, self._ref_starts)
+
+  def closest_ref_lengths(self, hyp_lengths):
+    """Length of the reference closest to each hypothesis length.
+    Ties go to the shorter reference. hyp_lengths covers the first
+    len(hyp_lengths) segments.
+    """
+    num_segments = len(hyp_lengths)
+    if not num_segments:
+      return np.zeros(0, dtype=np.int64)
+    in_range = self._ref_owners < num_segments
+    ref_lengths = self.ref_lengths[in_range]
+    distances = np.abs(ref_lengths - hyp_lengths[self._ref_owners[in_range]])
+    # Order by distance, then length, within one integer.
+    scale = ref_lengths.max() + 1
+    closest = np.minimum.reduceat(distances * scale + ref_lengths,
+                                  self._ref_starts[:num_segments])
+    return closest % scale
+
+  def clipped_matches(self, translation_corpus, max_order=None):
+    """Clipped n-gram matches of a tokenized translation corpus.
+    Returns:
+      Integer array of shape (N, max_order) with the clipped matches of each
+      translation for orders 1..max_order.
+    """
+    if max_order is None:
+      max_order = self.max_order
+    elif max_order > self.max_order:
+      raise ValueError("references were prepared up to order %d, not %d"
+                       % (self.max_order, max_order))
+    hyp_tables = self.vocab.corpus_ngram_tables(translation_corpus, max_order)
+    matches = np.zeros((len(translation_corpus), max_order), dtype=np.int64)
+    for order, (hyp_table, ref_table) in enumerate(zip(hyp_tables,
+                                                       self.tables)):
+      matches[:, order] = table_segment_totals(
+          table_intersection(hyp_table, ref_table), len(translation_corpus))
+    return matches
+
+
+def _prepare_references(reference_corpus, max_order):
+  """Returns reference_corpus as PreparedReferences, preparing it if needed."""
+  if isinstance(reference_corpus, PreparedReferences):
+    return reference_corpus
+  return PreparedReferences(reference_corpus, max_order)
+
+
+def bleu_statistics(reference_corpus, translation_corpus, max_order=4):
+  """Collects the BLEU sufficient statistics of every segment in one matrix.
+  Args:
+    reference_corpus: list of lists of references for each translation. Each
+        reference should be tokenized into a list of tokens. May also be
+        PreparedReferences prepared upto at least max_order.
+    translation_corpus: list of translations to score. Each translation
+        should be tokenized into a list of tokens.
+    max_order: highest n-gram order to count.
+  Returns:
+    Integer array of shape (N, 2 * max_order + 2). Row i holds the clipped
+    n-gram matches of segment i for orders 1..max_order, then its numbers of
+    hypothesis n-grams, then the hypothesis length and the length of the
+    closest reference.
+  """
+  references = _prepare_references(reference_corpus, max_order)
+  translation_corpus = translation_corpus[:len(references)]
+  hyp_lengths = np.array([len(t) for t in translation_corpus], dtype=np.int64)
+  totals = np.maximum(hyp_lengths[:, None] - np.arange(max_order), 0)
+  return np.column_stack([
+      references.clipped_matches(translation_corpus, max_order), totals,
+      hyp_lengths, references.closest_ref_lengths(hyp_lengths)])
+
+
+def _split_statistics(stats):
+  """Splits a bleu_statistics matrix into matches, totals and lengths."""
+  max_order = (stats.shape[1] - 2) // 2
+  return (stats[:, :max_order], stats[:, max_order:2 * max_order],
+          stats[:, -2], stats[:, -1])
+
+
+SMOOTHING_METHODS = tuple(range(8))
+
+
+def _smoothed_precisions(stats, order, method, epsilon=0.1, alpha=5, k=5):
+  """Modified precisions of orders 1..order after Chen & Cherry smoothing.
+  Vectorized over all rows of the statistics, following nltk's
+  SmoothingFunction methods 0-7. Boxing Chen and Collin Cherry (2014) A
+  Systematic Comparison of Smoothing Techniques for Sentence-Level BLEU.
+  Methods 5 and 7 average each precision with the next order's, and, like
+  nltk, with the raw 5-gram precision after the last order, whatever the
+  order; a row's result therefore depends on order. Method 6 is applied
+  to every row, including those nltk rejects for a zero trigram precision.
+  Args:
+    stats: matrix returned by bleu_statistics.
+    order: number of n-gram orders to smooth.
+    method: smoothing method, one of SMOOTHING_METHODS.
+    epsilon: count added to zero matches by method 1.
+    alpha: prior weight of method 6.
+    k: constant of method 4.
+  Returns:
+    Float array of shape (N, order). Precisions still zero after smoothing
+    are left out of the geometric mean, as nltk does.
+  """
+  matches, totals, hyp_len, _ = _split_statistics(stats)
+  needed_order = max(order, 5) if method in (5, 7) else order
+  if needed_order > matches.shape[1]:
+    raise ValueError("smoothing method %d needs %d-gram statistics, got "
+                     "max_order %d" % (method, needed_order, matches.shape[1]))
+  matches = matches.astype(float)
+  denominators = np.maximum(totals, 1)
+  precisions = matches[:, :order] / denominators[:, :order]
+  zero = matches[:, :order] == 0
+
+  if method == 0:
+    return np.where(zero, sys.float_info.min, precisions)
+  if method == 1:
+    return np.where(zero, epsilon / denominators[:, :order], precisions)
+  if method == 2:
+    smoothed = (matches[:, :order] + 1) / (denominators[:, :order] + 1)
+    smoothed[:, 0] = precisions[:, 0]
+    return smoothed
+  if method == 3:
+    geometric = 2. ** np.cumsum(zero, axis=1) * denominators[:, :order]
+    return np.where(zero, 1 / geometric, precisions)
+  if method in (4, 7):
+    zero &= (hyp_len > 1)[:, None]
+    with np.errstate(divide='ignore'):
+      numerators = (np.log(hyp_len)[:, None] /
+                    (2. ** np.cumsum(zero, axis=1) * k))
+    precisions = np.where(zero, numerators / denominators[:, :order],
+                          precisions)
+    if method == 4:
+      return precisions
+  if method in (5, 7):
+    next_precisions = np.column_stack(
+        [precisions[:, 1:], matches[:, 4] / denominators[:, 4]])
+    smoothed = np.empty_like(precisions)
+    previous = precisions[:, 0] + 1
+    for i in range(order):
+      previous = (previous + precisions[:, i] + next_precisions[:, i]) / 3
+      smoothed[:, i] = previous
+    return smoothed
+  if method == 6:
+    for i in range(2, order):
+      with np.errstate(divide='ignore', invalid='ignore'):
+        prior = np.where(precisions[:, i-2] == 0, 0.,
+                         precisions[:, i-1] ** 2 / precisions[:, i-2])
+      precisions[:, i] = ((matches[:, i] + alpha * prior) /
+                          (totals[:, i] + alpha))
+    return precisions
+  raise ValueError("unknown smoothing method %r, expected one of %r"
+                   % (method, SMOOTHING_METHODS))
+
+
+def _brevity_penalty(hyp_len, ref_len):
+  """Element-wise brevity penalty, 0 for empty hypotheses."""
+  ratio = ref_len / np.maximum(hyp_len, 1)
+  bp = np.where(hyp_len > ref_len, 1., np.exp(1 - ratio))
+  return np.where(hyp_len > 0, bp, 0.)
+
+
+def _weight_matrix(weights_list, max_order):
+  """Stacks weight tuples into a zero-padded (K, order) float matrix."""
+  order = max(len(weights) for weights in weights_list)
+  if order > max_order:
+    raise ValueError("weights need %d-gram statistics, got max_order %d"
+                     % (order, max_order))
+  weight_matrix = np.zeros((len(weights_list), order))
+  for k, weights in enumerate(weights_list):
+    weight_matrix[k, :len(weights)] = weights
+  return weight_matrix
+
+
+def _is_weights_batch(weights):
+  return isinstance(weights[0], (tuple, list, np.ndarray))
+
+
+def sentence_bleu_from_stats(stats, weights=(0.25, 0.25, 0.25, 0.25),
+                             smoothing=0):
+  """Computes sentence BLEU for every row of a statistics matrix at once.
+  A list of weight tuples is evaluated as a single product of the
+  (N, order) log-precision matrix with the (order, K) weight matrix.
+  Scores are the same as nltk's sentence_bleu with the matching
+  SmoothingFunction method; method 0 is nltk's default of no smoothing.
+  Args:
+    stats: matrix returned by bleu_statistics.
+    weights: weight tuple for unigrams, bigrams and so on, or a list of such
+        tuples. None may be longer than the max_order of the statistics.
+    smoothing: Chen & Cherry smoothing method, one of SMOOTHING_METHODS, or
+        a list of methods to compute all at once.
+  Returns:
+    Float array with one BLEU score per segment, or of shape (N, K) when a
+    list of K weight tuples is given. A list of S smoothing methods adds a
+    leading axis of length S.
+  """
+  if isinstance(smoothing, (tuple, list, range)):
+    return np.stack([sentence_bleu_from_stats(stats, weights, method)
+                     for method in smoothing])
+  batched = _is_weights_batch(weights)
+  weights_list = weights if batched else [weights]
+  matches, _, hyp_len, ref_len = _split_statistics(stats)
+  weight_matrix = _weight_matrix(weights_list, matches.shape[1])
+  # Smoothing is done at each weighting's own order, so that a score does not
+  # depend on the other weightings it is batched with.
+  lengths = np.array([len(weights) for weights in weights_list])
+  weighted_logs = np.empty((len(stats), len(weights_list)))
+  for order in np.unique(lengths):
+    columns = lengths == order
+    precisions = _smoothed_precisions(stats, order, smoothing)
+    log_precisions = np.log(np.where(precisions > 0, precisions, 1.))
+    weighted_logs[:, columns] = (log_precisions @
+                                 weight_matrix[columns, :order].T)
+  scores = _brevity_penalty(hyp_len, ref_len)[:, None] * np.exp(weighted_logs)
+  scores = np.where(matches[:, :1] > 0, scores, 0.)
+  return scores if batched else scores[:, 0]
+
+
+def corpus_bleu_from_stats(stats, weights=(0.25, 0.25, 0.25, 0.25),
+                           smoothing=0):
+  """Computes corpus BLEU from the summed statistics of all segments.
+  Matches, n-gram totals and lengths are summed over segments before the
+  precisions and brevity penalty are taken, as in Papineni et al. (2002),
+  rather than averaging sentence scores. Smoothing is applied to the summed
+  counts.
+  Args:
+    stats: matrix returned by bleu_statistics.
+    weights: weight tuple for unigrams, bigrams and so on, or a list of such
+        tuples.
+    smoothing: smoothing method, or a list of methods, as for
+        sentence_bleu_from_stats.
+  Returns:
+    Corpus BLEU score, or an array of K scores when a list of K weight tuples
+    is given. A list of S smoothing methods adds a leading axis of length S.
+  """
+  scores = sentence_bleu_from_stats(stats.sum(axis=0, keepdims=True), weights,
+                                    smoothing)
+  return scores[..., 0, :] if _is_weights_batch(weights) else scores[..., 0]
+
+
+def sentence_bleu_scores(references, hypothesis, weights_list, smoothing=0):
+  """Computes sentence BLEU under several weightings from one n-gram pass.
+  Args:
+    references: list of references for the hypothesis. Each reference should
+        be tokenized into a list of tokens.
+    hypothesis: tokenized hypothesis to score.
+    weights_list: list of weight tuples, one per BLEU variant to compute.
+    smoothing: smoothing method, one of SMOOTHING_METHODS.
+  Returns:
+    List with one BLEU score per entry of weights_list.
+  """
+  max_order = max(len(weights) for weights in weights_list)
+  if smoothing in (5, 7):
+    # Methods 5 and 7 also use the 5-gram precision, as nltk does.
+    max_order = max(max_order, 5)
+  stats = bleu_statistics([references], [hypothesis], max_order)
+  return sentence_bleu_from_stats(stats, weights_list, smoothing)[0].tolist()
 
 
 def _get_ngrams(segment, max_order):
@@ -42,12 +533,105 @@ def _get_ngrams(segment, max_order):
   return ngram_counts
 
 
+class BleuAccumulator(object):
+  """Streams corpus BLEU statistics with an update/merge/result interface.
+  The whole state is a fixed-size vector of 2 * max_order + 2 counts: clipped
+  matches and possible matches per order, then the translation length and the
+  shortest reference length, summed over the sentence pairs seen so far.
+  Accumulators filled on different shards can be merged before result() is
+  taken, which gives the same score as compute_bleu over the whole corpus.
+  Args:
+    max_order: Maximum n-gram order to use when computing BLEU score.
+    smooth: Whether or not to apply Lin et al. 2004 smoothing.
+  """
+
+  def __init__(self, max_order=4, smooth=False):
+    self.max_order = max_order
+    self.smooth = smooth
+    self.counts = np.zeros(2 * max_order + 2, dtype=np.int64)
+
+  def update(self, references, translation):
+    """Adds one translation, tokenized, and its tokenized references.
+    A single pair is clipped with plain Counters rather than the n-gram
+    tables of update_corpus, whose setup costs more than one pair saves.
+    """
+    if not references:
+      raise ValueError("Every segment needs at least one reference")
+    max_order = self.max_order
+    merged_ref_ngram_counts = collections.Counter()
+    for reference in references:
+      merged_ref_ngram_counts |= _get_ngrams(reference, max_order)
+    overlap = _get_ngrams(translation, max_order) & merged_ref_ngram_counts
+    counts = [0] * (2 * max_order + 2)
+    for ngram, count in overlap.items():
+      counts[len(ngram) - 1] += count
+    for order in range(1, max_order + 1):
+      counts[max_order + order - 1] = max(len(translation) - order + 1, 0)
+    counts[-2] = len(translation)
+    counts[-1] = min(len(r) for r in references)
+    self.counts += counts
+    return self
+
+  def update_corpus(self, reference_corpus, translation_corpus):
+    """Adds a whole corpus, as taken by compute_bleu, in one batch."""
+    references = _prepare_references(reference_corpus, self.max_order)
+    stats = bleu_statistics(references, translation_corpus, self.max_order)
+    stats[:, -1] = references.shortest_ref_lengths()[:len(stats)]
+    self.counts += stats.sum(axis=0)
+    return self
+
+  def merge(self, other):
+    """Adds the counts of another accumulator, e.g. from another worker."""
+    if other.max_order != self.max_order:
+      raise ValueError("cannot merge BLEU counts of max_order %d and %d"
+                       % (self.max_order, other.max_order))
+    self.counts += other.counts
+    return self
+
+  def result(self):
+    """Returns the same tuple as compute_bleu for the pairs seen so far."""
+    max_order = self.max_order
+    matches_by_order = self.counts[:max_order].tolist()
+    possible_matches_by_order = self.counts[max_order:2 * max_order].tolist()
+    translation_length, reference_length = self.counts[-2:].tolist()
+
+    precisions = [0] * max_order
+    for i in range(0, max_order):
+      if self.smooth:
+        precisions[i] = ((matches_by_order[i] + 1.) /
+                         (possible_matches_by_order[i] + 1.))
+      else:
+        if possible_matches_by_order[i] > 0:
+          precisions[i] = (float(matches_by_order[i]) /
+                           possible_matches_by_order[i])
+        else:
+          precisions[i] = 0.0
+
+    if min(precisions) > 0:
+      p_log_sum = sum((1. / max_order) * math.log(p) for p in precisions)
+      geo_mean = math.exp(p_log_sum)
+    else:
+      geo_mean = 0
+
+    ratio = float(translation_length) / reference_length
+
+    if ratio > 1.0:
+      bp = 1.
+    else:
+      bp = math.exp(1 - 1. / ratio)
+
+    bleu = geo_mean * bp
+
+    return (bleu, precisions, bp, ratio, translation_length, reference_length)
+
+
 def compute_bleu(reference_corpus, translation_corpus, max_order=4,
                  smooth=False):
   """Computes BLEU score of translated segments against one or more references.
   Args:
     reference_corpus: list of lists of references for each translation. Each
-        reference should be tokenized into a list of tokens.
+        reference should be tokenized into a list of tokens. May also be
+        PreparedReferences, to reuse the reference n-gram tables across calls.
     translation_corpus: list of translations to score. Each translation
         should be tokenized into a list of tokens.
     max_order: Maximum n-gram order to use when computing BLEU score.
@@ -56,139 +640,860 @@ def compute_bleu(reference_corpus, translation_corpus, max_order=4,
     3-Tuple with the BLEU score, n-gram precisions, geometric mean of n-gram
     precisions and brevity penalty.
   """
-  matches_by_order = [0] * max_order
-  possible_matches_by_order = [0] * max_order
-  reference_length = 0
-  translation_length = 0
-  for (references, translation) in zip(reference_corpus,
-                                       translation_corpus):
-    reference_length += min(len(r) for r in references)
-    translation_length += len(translation)
+  accumulator = BleuAccumulator(max_order, smooth)
+  accumulator.update_corpus(reference_corpus, translation_corpus)
+  return accumulator.result()
 
-    merged_ref_ngram_counts = collections.Counter()
-    for reference in references:
-      merged_ref_ngram_counts |= _get_ngrams(reference, max_order)
-    translation_ngram_counts = _get_ngrams(translation, max_order)
-    overlap = translation_ngram_counts & merged_ref_ngram_counts
-    for ngram in overlap:
-      matches_by_order[len(ngram)-1] += overlap[ngram]
-    for order in range(1, max_order+1):
-      possible_matches = len(translation) - order + 1
-      if possible_matches > 0:
-        possible_matches_by_order[order-1] += possible_matches
-
-  precisions = [0] * max_order
-  for i in range(0, max_order):
-    if smooth:
-      precisions[i] = ((matches_by_order[i] + 1.) /
-                       (possible_matches_by_order[i] + 1.))
-    else:
-      if possible_matches_by_order[i] > 0:
-        precisions[i] = (float(matches_by_order[i]) /
-                         possible_matches_by_order[i])
-      else:
-        precisions[i] = 0.0
 
-  if min(precisions) > 0:
-    p_log_sum = sum((1. / max_order) * math.log(p) for p in precisions)
-    geo_mean = math.exp(p_log_sum)
-  else:
-    geo_mean = 0
+def compute_rouge_n(reference_corpus, translation_corpus, n=2):
+  """Computes ROUGE-N of every segment from its clipped n-gram overlap.
+  Args:
+    reference_corpus: list of references, one per translation, each
+        tokenized into a list of tokens.
+    translation_corpus: list of translations to score. Each translation
+        should be tokenized into a list of tokens. Segments beyond the shorter
+        of the two corpora are ignored.
+    n: n-gram order.
+  Returns:
+    3-Tuple of float arrays with the recall, precision and F1 of each segment,
+    0 where the segment has no n-grams of that order.
+  """
+  num_segments = min(len(reference_corpus), len(translation_corpus))
+  vocab = NgramVocabulary()
+  ref_table = vocab.corpus_ngram_tables(reference_corpus[:num_segments], n)[-1]
+  hyp_table = vocab.corpus_ngram_tables(translation_corpus[:num_segments],
+                                        n)[-1]
+  overlap = table_segment_totals(table_intersection(hyp_table, ref_table),
+                                 num_segments)
+  ref_totals = table_segment_totals(ref_table, num_segments)
+  hyp_totals = table_segment_totals(hyp_table, num_segments)
+  recall = overlap / np.maximum(ref_totals, 1)
+  precision = overlap / np.maximum(hyp_totals, 1)
+  f1 = 2 * overlap / np.maximum(ref_totals + hyp_totals, 1)
+  return recall, precision, f1
 
-  ratio = float(translation_length) / reference_length
 
-  if ratio > 1.0:
-    bp = 1.
-  else:
-    bp = math.exp(1 - 1. / ratio)
 
-  bleu = geo_mean * bp
+#%%############################################################################
+'''                                  TER                                    '''
+###############################################################################
 
-  return (bleu, precisions, bp, ratio, translation_length, reference_length)
 
+import bisect
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
 
+def ld_rows(row, s, t):
+    """
+    Advances a row of the Levenshtein DP table of s against t over the tokens
+    of s, yielding the row reached after each token. row holds the distances
+    of the tokens of s seen so far to every prefix of t.
+    """
+    for s_token in s:
+        current = [row[0] + 1]
+        for j, t_token in enumerate(t):
+            if s_token == t_token:
+                current.append(row[j])
+            else:
+                # Deletion, insertion or substitution.
+                current.append(1 + min(row[j+1], current[j], row[j]))
+        row = current
+        yield row
 
-#%%############################################################################
-'''                                  TER                                    '''
-###############################################################################
+def ld(s, t, max_distance=None):
+    """
+    Levenshtein distance of two token sequences, e.g. interned token ids.
+    Iterative over two rows of the DP table, so it runs in O(len(s)*len(t))
+    time with O(min(len(s), len(t))) memory and constant stack depth.
+    With max_distance, returns max_distance + 1 for any larger distance,
+    see banded_ld.
+    """
+    if len(s) < len(t):
+        s, t = t, s
+    if max_distance is not None:
+        return banded_ld(s, t, max_distance)
+    row = list(range(len(t) + 1))
+    for row in ld_rows(row, s, t):
+        pass
+    return row[-1]
+
+def banded_ld(s, t, max_distance):
+    """
+    Levenshtein distance of s and t if at most max_distance, otherwise
+    max_distance + 1, after Ukkonen. Only the band of cells within
+    max_distance of the diagonal can hold a distance that small, so only
+    that band is filled, and the search stops at the first row whose band
+    is entirely over max_distance: O(max_distance * len(s)) time.
+    """
+    k = max_distance
+    over = k + 1
+    if abs(len(s) - len(t)) > k:
+        return over
+    previous = [j if j <= k else over for j in range(len(t) + 1)]
+    current = [over] * (len(t) + 1)
+    for i, s_token in enumerate(s, 1):
+        low, high = max(1, i - k), min(len(t), i + k)
+        # The cell left of the band still holds a value from two rows up.
+        current[low-1] = i if low == 1 else over
+        for j in range(low, high + 1):
+            if s_token == t[j-1]:
+                current[j] = previous[j-1]
+            else:
+                # Deletion, insertion or substitution.
+                current[j] = 1 + min(previous[j], current[j-1],
+                                     previous[j-1])
+        if min(current[low-1:high+1]) > k:
+            return over
+        previous, current = current, previous
+    return min(previous[-1], over)
 
+def bag_lower_bound(hyp, ref):
+    """
+    Lower bound on the edits of hyp to ref, shifts included: the words of
+    either side missing from the other, counted as multisets. Shifts do not
+    change either multiset, and every other edit fixes at most one missing
+    word on each side.
+    """
+    hyp_counts = collections.Counter(hyp)
+    ref_counts = collections.Counter(ref)
+    return max(sum((hyp_counts - ref_counts).values()),
+               sum((ref_counts - hyp_counts).values()))
 
-from functools import lru_cache
-from itertools import product
+def ld_table(s, t):
+    """All rows of the Levenshtein DP table of s against t."""
+    first = list(range(len(t) + 1))
+    return [first] + list(ld_rows(first, s, t))
 
-@lru_cache(maxsize=4095)
-def ld(s, t):
+def table_trace(rows, s, t):
     """
-    Levenshtein distance memoized implementation from Rosetta code:
-    https://rosettacode.org/wiki/Levenshtein_distance#Python
+    Edit operations rewriting s into t, read back from the filled DP table
+    rows of ld_table, as a string over OP_MATCH, OP_SUB, OP_INS and OP_DEL.
+    Ties prefer a match or substitution, then a deletion, then an insertion.
     """
-    if not s: return len(t)
-    if not t: return len(s)
-    if s[0] == t[0]: return ld(s[1:], t[1:])
-    l1 = ld(s, t[1:])      # Deletion.
-    l2 = ld(s[1:], t)      # Insertion.
-    l3 = ld(s[1:], t[1:])  # Substitution.
-    return 1 + min(l1, l2, l3)
+    trace = []
+    i, j = len(s), len(t)
+    while i > 0 or j > 0:
+        cost = i > 0 and j > 0 and int(s[i-1] != t[j-1])
+        if i > 0 and j > 0 and rows[i][j] == rows[i-1][j-1] + cost:
+            trace.append(OP_SUB if cost else OP_MATCH)
+            i, j = i - 1, j - 1
+        elif i > 0 and rows[i][j] == rows[i-1][j] + 1:
+            trace.append(OP_DEL)
+            i -= 1
+        else:
+            trace.append(OP_INS)
+            j -= 1
+    return ''.join(reversed(trace))
+
+def shift_spans(hyp, ref):
+    """
+    Find possible shifts in hypothesis, as (i, j, l): the phrase of length l
+    at position i of hyp matches ref at position j, and is moved there.
+    Only positions where the hypothesis word occurs in the reference are
+    tried, looked up in a word -> positions index of the reference. The
+    length of the matching phrase is scanned once at the start of each
+    phrase and carried along it, one word shorter at each later position.
+    """
+    positions = {}
+    for j, word in enumerate(ref):
+        positions.setdefault(word, []).append(j)
+    runs = {}
+    for i, word in enumerate(hyp):
+        # Matching phrase lengths at (i, j), keyed by j.
+        phrase_runs = {}
+        for j in positions.get(word, ()):
+            l = runs.get(j - 1, 0) - 1
+            if l <= 0:
+                # Find the longest matching phrase from this position
+                l = 1
+                while (i + l < len(hyp) and j + l < len(ref)
+                       and hyp[i+l] == ref[j+l]):
+                    l += 1
+            phrase_runs[j] = l
+            if i == j: # Skip words in the same position.
+                continue
+            yield i, j, l
+        runs = phrase_runs
+
+def apply_shift(hyp, i, j, l):
+    """Moves the phrase of length l at position i of hyp to position j."""
+    shifted_hyp = hyp[:i] + hyp[i+l:]
+    shifted_hyp[j:j] = hyp[i:i+l]
+    return shifted_hyp
 
 def find_shifts(hyp, ref):
     """Find possible shifts in hypothesis."""
-    hyp_len, ref_len = len(hyp), len(ref)
-    for i, j in product(range(hyp_len), range(ref_len)):
-        if i == j: # Skip words in the same position.
-            continue
-        # When word matches.
-        if hyp[i] == ref[j]: 
-            # Find the longest matching phrase from this position
+    for i, j, l in shift_spans(hyp, ref):
+        # Compute the shifted hypothesis.
+        yield apply_shift(hyp, i, j, l)
+
+def best_shift(hyp, ref):
+    """
+    Find the shift that most reduces the edit distance of hyp to ref.
+    Returns the reduction, the shifted hypothesis, the shift as (start,
+    length, new start) of the moved phrase, None if there is no candidate,
+    and the rows of the DP table of hyp itself, as ld_table gives them, so
+    that the distance and trace of a final hypothesis are not computed again.
+    A shifted hypothesis only differs from hyp between the first and last
+    position the shift touches. Its distance is computed from the DP row of
+    the unchanged prefix, advanced over the changed span only, and joined
+    with the DP row of the unchanged suffix, computed backwards on reversed
+    sequences: d(x + y, r) = min_k d(x, r[:k]) + d(y, r[k:]).
+    """
+    hyp_len = len(hyp)
+    first = list(range(len(ref) + 1))
+    prefix_rows = [first] + list(ld_rows(first, hyp, ref))
+    suffix_rows = [first] + list(ld_rows(first, hyp[::-1], ref[::-1]))
+    # suffix_rows[q][k] becomes the distance of hyp[q:] to ref[k:].
+    suffix_rows = [row[::-1] for row in reversed(suffix_rows)]
+    original = prefix_rows[-1][-1]
+    # Track the lowest possible shift and its distance in one pass.
+    best = None
+    for i, j, l in shift_spans(hyp, ref):
+        start = min(i, j)
+        end = max(i, min(j, hyp_len - l)) + l
+        shifted_hyp = apply_shift(hyp, i, j, l)
+        row = prefix_rows[start]
+        for row in ld_rows(row, shifted_hyp[start:end], ref):
+            pass
+        delta = original - min(map(sum, zip(row, suffix_rows[end])))
+        if best is None or (delta, shifted_hyp) > best[:2]:
+            best = (delta, shifted_hyp, (i, l, min(j, hyp_len - l)))
+    # Return original hypothesis if shift is not better.
+    if best is None:
+        best = (0, hyp, None)
+    return best + (prefix_rows,)
+
+def shift(hyp, ref):
+    """Find the shift that most reduces the edit distance, see best_shift."""
+    return best_shift(hyp, ref)[:2]
+
+# Tercom limits. Shifts move at most TERCOM_MAX_SHIFT_SIZE words by at most
+# TERCOM_MAX_SHIFT_DIST positions, edit distances are only computed within
+# TERCOM_BEAM_WIDTH cells of the diagonal, and the search for shifts stops
+# after TERCOM_MAX_SHIFT_CANDIDATES candidates per segment.
+TERCOM_MAX_SHIFT_SIZE = 10
+TERCOM_MAX_SHIFT_DIST = 50
+TERCOM_BEAM_WIDTH = 25
+TERCOM_MAX_SHIFT_CANDIDATES = 1000
+TERCOM_MAX_CACHE_SIZE = 10000
+
+# Edit operations of a trace rewriting the hypothesis into the reference:
+# deletions remove hypothesis words, insertions add reference words. Shifts
+# are listed apart from the trace and written out as OP_SHIFT.
+OP_MATCH, OP_SUB, OP_INS, OP_DEL, OP_SHIFT = 'M', 'S', 'I', 'D', 'T'
+
+class TercomEditDistance(object):
+    """
+    Beam edit distance of hypotheses to one reference, as computed by tercom.
+    Rows of the DP table are cached in a trie keyed by the hypothesis tokens,
+    so a hypothesis only computes the rows after its longest cached prefix.
+    Every shifted hypothesis shares a prefix with the one it was shifted from.
+    """
+
+    def __init__(self, ref, beam_width=TERCOM_BEAM_WIDTH,
+                 max_cache_size=TERCOM_MAX_CACHE_SIZE):
+        self.ref = ref
+        self.beam_width = beam_width
+        self.max_cache_size = max_cache_size
+        self._initial_row = [(j, OP_INS) for j in range(len(ref) + 1)]
+        self._empty_row = [(float('inf'), None)] * (len(ref) + 1)
+        self._cache = {}
+        self._cache_size = 0
+
+    def __call__(self, hyp):
+        """Returns the edit distance of hyp to the reference and its trace."""
+        # Skip the rows of the longest prefix of hyp already computed.
+        node, rows = self._cache, [self._initial_row]
+        for token in hyp:
+            if token not in node:
+                break
+            node, row = node[token]
+            rows.append(row)
+        start = len(rows) - 1
+        rows.extend(list(self._empty_row) for _ in range(len(hyp) - start))
+
+        ref, ref_len, hyp_len = self.ref, len(self.ref), len(hyp)
+        length_ratio = ref_len / hyp_len if hyp else 1
+        # Widen the beam if the rows would not overlap otherwise.
+        if self.beam_width < length_ratio / 2:
+            beam_width = math.ceil(length_ratio / 2 + self.beam_width)
+        else:
+            beam_width = self.beam_width
+        for i in range(start + 1, hyp_len + 1):
+            diagonal = math.floor(i * length_ratio)
+            min_j = max(0, diagonal - beam_width)
+            max_j = ref_len + 1 if i == hyp_len else min(ref_len + 1,
+                                                         diagonal + beam_width)
+            previous, current = rows[i-1], rows[i]
+            for j in range(min_j, max_j):
+                if j == 0:
+                    current[j] = (previous[j][0] + 1, OP_DEL)
+                    continue
+                if hyp[i-1] == ref[j-1]:
+                    best = (previous[j-1][0], OP_MATCH)
+                else:
+                    best = (previous[j-1][0] + 1, OP_SUB)
+                # Ties prefer a match or substitution, then a deletion, then
+                # an insertion.
+                if previous[j][0] + 1 < best[0]:
+                    best = (previous[j][0] + 1, OP_DEL)
+                if current[j-1][0] + 1 < best[0]:
+                    best = (current[j-1][0] + 1, OP_INS)
+                if best[0] < current[j][0]:
+                    current[j] = best
+
+        trace = []
+        i, j = hyp_len, ref_len
+        while i > 0 or j > 0:
+            op = rows[i][j][1]
+            trace.append(op)
+            if op in (OP_MATCH, OP_SUB):
+                i, j = i - 1, j - 1
+            elif op == OP_INS:
+                j -= 1
+            else:
+                i -= 1
+        trace.reverse()
+
+        if self._cache_size < self.max_cache_size:
+            node = self._cache
+            for token in hyp[:start]:
+                node = node[token][0]
+            for token, row in zip(hyp[start:], rows[start+1:]):
+                if token not in node:
+                    node[token] = ({}, tuple(row))
+                    self._cache_size += 1
+                node = node[token][0]
+        return rows[-1][-1][0], trace
+
+def trace_alignment(trace):
+    """
+    Aligns the hypothesis to the reference along an edit trace.
+    Returns a dict from each reference position to the hypothesis position
+    aligned to it, and lists of 0/1 error flags of the reference and of the
+    hypothesis positions.
+    """
+    align, ref_err, hyp_err = {}, [], []
+    pos_hyp = pos_ref = -1
+    # The trace rewrites the hypothesis into the reference, so insertions and
+    # deletions swap sides.
+    for op in trace:
+        if op in (OP_MATCH, OP_SUB):
+            pos_hyp += 1
+            pos_ref += 1
+            align[pos_ref] = pos_hyp
+            hyp_err.append(int(op == OP_SUB))
+            ref_err.append(int(op == OP_SUB))
+        elif op == OP_DEL:
+            pos_hyp += 1
+            hyp_err.append(1)
+        else:
+            pos_ref += 1
+            align[pos_ref] = pos_hyp
+            ref_err.append(1)
+    return align, ref_err, hyp_err
+
+def tercom_shift_spans(hyp, ref, max_shift_size=TERCOM_MAX_SHIFT_SIZE,
+                       max_shift_dist=TERCOM_MAX_SHIFT_DIST):
+    """
+    Find tercom's shift candidates, as (i, j, l): hyp[i:i+l] matches
+    ref[j:j+l], for every l upto the longest match or max_shift_size, and j
+    is at most max_shift_dist positions from i. The reference positions of
+    each hypothesis word come from a word -> positions index.
+    """
+    positions = {}
+    for j, word in enumerate(ref):
+        positions.setdefault(word, []).append(j)
+    for i, word in enumerate(hyp):
+        word_positions = positions.get(word, [])
+        low = bisect.bisect_left(word_positions, i - max_shift_dist)
+        high = bisect.bisect_right(word_positions, i + max_shift_dist)
+        for j in word_positions[low:high]:
             l = 0
-            for l, (h, r) in enumerate(zip(hyp[i:], ref[j:])):
-                if h != r:
-                    break
+            while (l < max_shift_size and i + l < len(hyp) and j + l < len(ref)
+                   and hyp[i+l] == ref[j+l]):
                 l += 1
-            # Compute the shifted hypothesis.
-            shifted_hyp = hyp[:i] + hyp[i+l:]
-            shifted_hyp[j:j] = hyp[i:i+l]
-            yield shifted_hyp
-            
-def shift(hyp, ref):
-    original = ld(tuple(hyp), tuple(ref))
-    # Find the lowest possible shift and it distance.
-    scores = []
-    for shifted_hyp in find_shifts(hyp, ref):
-        shifted_dist = ld(tuple(shifted_hyp), tuple(ref))
-        scores.append((original - shifted_dist, shifted_hyp))
-    # Return original hypothesis if shift is not better.
-    return sorted(scores)[-1] if scores else (0, hyp)
-        
-def ter(hyp, ref):
+                yield i, j, l
+
+def move_phrase(hyp, i, l, target):
+    """Moves the phrase of length l at position i of hyp before target."""
+    if target < i:
+        return hyp[:target] + hyp[i:i+l] + hyp[target:i] + hyp[i+l:]
+    if target > i + l:
+        return hyp[:i] + hyp[i+l:target] + hyp[i:i+l] + hyp[target:]
+    return hyp[:i] + hyp[i+l:l+target] + hyp[i:i+l] + hyp[l+target:]
+
+def tercom_shift(hyp, ref, edit_distance, checked,
+                 max_shift_size=TERCOM_MAX_SHIFT_SIZE,
+                 max_shift_dist=TERCOM_MAX_SHIFT_DIST,
+                 max_candidates=TERCOM_MAX_SHIFT_CANDIDATES):
+    """
+    Find the shift that most reduces the edit distance, as ranked by tercom:
+    by gain, then longest phrase, then earliest phrase, then earliest target.
+    Returns the gain, the shifted hypothesis, the shift as (start, length,
+    new start) of the moved phrase, or None, and the updated number of
+    checked candidates.
+    """
+    original, trace = edit_distance(hyp)
+    align, ref_err, hyp_err = trace_alignment(trace)
+    best = None
+    for i, j, l in tercom_shift_spans(hyp, ref, max_shift_size,
+                                      max_shift_dist):
+        # Only move wrong hypothesis words onto wrong reference words, and
+        # not within the phrase itself.
+        if not any(hyp_err[i:i+l]) or not any(ref_err[j:j+l]):
+            continue
+        if i <= align[j] < i + l:
+            continue
+        previous_target = -1
+        for offset in range(-1, l):
+            if j + offset == -1:
+                target = 0
+            elif j + offset in align:
+                target = align[j + offset] + 1
+            else:
+                break
+            if target == previous_target:
+                continue
+            previous_target = target
+            shifted_hyp = move_phrase(hyp, i, l, target)
+            candidate = (original - edit_distance(shifted_hyp)[0], l, -i,
+                         -target, shifted_hyp)
+            checked += 1
+            if best is None or candidate > best:
+                best = candidate
+        if checked >= max_candidates:
+            break
+    if best is None:
+        return 0, hyp, None, checked
+    delta, l, i, target, shifted_hyp = best
+    i, target = -i, -target
+    # The phrase moves before target, which is l words earlier once the
+    # phrase is taken out in front of it.
+    new_start = target - l if target > i + l else target
+    return delta, shifted_hyp, (i, l, new_start), checked
+
+def tercom_edits(hyp, ref, max_shift_size=TERCOM_MAX_SHIFT_SIZE,
+                 max_shift_dist=TERCOM_MAX_SHIFT_DIST,
+                 beam_width=TERCOM_BEAM_WIDTH,
+                 max_candidates=TERCOM_MAX_SHIFT_CANDIDATES, trace=False):
+    """
+    Number of edits, shifts included, of hyp to ref under tercom's limits,
+    as counted by sacrebleu's TER. With trace=True, returns the edits, the
+    shifts applied and the edit trace of the shifted hypothesis, as
+    ter_edits does.
+    """
+    if not ref:
+        return (len(hyp), [], OP_DEL * len(hyp)) if trace else len(hyp)
+    edit_distance = TercomEditDistance(ref, beam_width)
+    shifts = []
+    checked = 0
+    while True:
+        delta, shifted_hyp, span, checked = tercom_shift(
+            hyp, ref, edit_distance, checked, max_shift_size, max_shift_dist,
+            max_candidates)
+        if checked >= max_candidates or delta <= 0:
+            break
+        shifts.append(span)
+        hyp = shifted_hyp
+    distance, ops = edit_distance(hyp)
+    if trace:
+        return len(shifts) + distance, shifts, ''.join(ops)
+    return len(shifts) + distance
+
+def ter_edits(hyp, ref, tercom=False, trace=False, max_edits=None):
+    """
+    Number of edits, shifts included, of hyp to ref as counted by TER. With
+    tercom=True, shifts are searched under tercom's limits, which bounds the
+    runtime and gives the same count as sacrebleu's case-sensitive TER.
+    With trace=True, returns the edits, the list of shifts applied, each as
+    (start, length, new start) of the moved phrase, and the edit trace of the
+    shifted hypothesis, read from the DP table of its edit distance.
+    With max_edits, returns max_edits + 1 for any larger number of edits,
+    stopping as soon as the bag-of-words lower bound, plus the shifts made,
+    is over it; the edit distance is then banded to max_edits. For ranking
+    and filtering, where only the edits below a threshold matter.
+    """
+    # Compare token ids rather than strings. Ids are numbered in the sorted
+    # order of the tokens, so best_shift breaks ties between equally good
+    # shifted hypotheses as it would on the strings.
+    ids = {word: k for k, word in enumerate(sorted(set(hyp).union(ref)))}
+    hyp, ref = [ids[word] for word in hyp], [ids[word] for word in ref]
+    if max_edits is not None:
+        if trace:
+            raise ValueError("max_edits cannot be combined with trace")
+        lower_bound = bag_lower_bound(hyp, ref)
+        if lower_bound > max_edits:
+            return max_edits + 1
+        if tercom:
+            return min(tercom_edits(hyp, ref), max_edits + 1)
+    if tercom:
+        return tercom_edits(hyp, ref, trace=trace)
     # Initialize no. of edits, e.
     e = 0
+    shifts = []
     while True:
+        if max_edits is not None and e + lower_bound > max_edits:
+            return max_edits + 1
         # Find shift, s, that most reduces min-edit-distance(h', r)
-        delta, s = shift(hyp, ref)
+        delta, s, span, rows = best_shift(hyp, ref)
         # until no shifts that reduce edit distance remain
         if delta <= 0:
             break
         # if shift reduces edit distance, then
         # h' <- apply s to h'
         hyp = s
+        shifts.append(span)
         # e <- e + 1
         e += 1
-    # e <- e + min-edit-distance(h', r)
-    e += ld(tuple(hyp), tuple(ref))
+    # e <- e + min-edit-distance(h', r), from the DP table best_shift filled
+    # for the final hypothesis.
+    e += rows[-1][-1]
+    if max_edits is not None:
+        return min(e, max_edits + 1)
+    if not trace:
+        return e
+    return e, shifts, table_trace(rows, hyp, ref)
+
+def edit_trace(hyp, ref):
+    """
+    WER edits of hyp to ref, as ter_edits(..., trace=True) without shifts:
+    the edit distance, an empty list of shifts and the edit trace.
+    """
+    rows = ld_table(hyp, ref)
+    return rows[-1][-1], [], table_trace(rows, hyp, ref)
+
+def write_edit_traces(path, traces):
+    """
+    Saves the traces of ter_edits or edit_trace, one per segment, as a
+    compressed NumPy archive of equal-length columns with one entry per
+    operation: segment index, operation code (OP_* as a byte), hypothesis
+    position, reference position and length. Each segment first lists its
+    shifts, in the order applied, with the start of the moved phrase as
+    hypothesis position, its new start as reference position and its length;
+    then its edit trace on the shifted hypothesis, with -1 for the missing
+    side of insertions and deletions.
+    """
+    segments, ops, hyp_positions, ref_positions, lengths = [], [], [], [], []
+    for segment, (_, shifts, trace) in enumerate(traces):
+        for start, length, new_start in shifts:
+            segments.append(segment)
+            ops.append(OP_SHIFT)
+            hyp_positions.append(start)
+            ref_positions.append(new_start)
+            lengths.append(length)
+        i = j = 0
+        for op in trace:
+            segments.append(segment)
+            ops.append(op)
+            hyp_positions.append(-1 if op == OP_INS else i)
+            ref_positions.append(-1 if op == OP_DEL else j)
+            lengths.append(1)
+            i += op != OP_INS
+            j += op != OP_DEL
+    np.savez_compressed(
+        path, segment=np.array(segments, dtype=np.int32),
+        op=np.frombuffer(''.join(ops).encode('ascii'), dtype=np.uint8),
+        hyp_pos=np.array(hyp_positions, dtype=np.int32),
+        ref_pos=np.array(ref_positions, dtype=np.int32),
+        length=np.array(lengths, dtype=np.int32))
+
+def ter(hyp, ref, tercom=False):
+    """TER of hyp against ref, see ter_edits."""
+    e = ter_edits(hyp, ref, tercom)
+    if tercom and not ref:
+        return 1.0 if e else 0.0
     return e / len(ref)
 
+def multi_ref_ter_edits(hyp, refs, tercom=False):
+    """
+    Fewest TER edits of hyp to any of refs, and the average reference
+    length, as tercom counts them for several references.
+    References are tried from the lowest lower bound on their edits: the
+    bag-of-words difference, which is never below the length difference.
+    Once that bound is not below the best edits found so far, the remaining
+    references are skipped, and the others are only searched upto one edit
+    fewer than the best.
+    """
+    if not refs:
+        raise ValueError("Every hypothesis needs at least one reference")
+    avg_ref_len = sum(len(ref) for ref in refs) / len(refs)
+    best = None
+    for bound, k in sorted((bag_lower_bound(hyp, ref), k)
+                           for k, ref in enumerate(refs)):
+        if best is None:
+            best = ter_edits(hyp, refs[k], tercom)
+        elif bound >= best:
+            break
+        else:
+            best = min(best, ter_edits(hyp, refs[k], tercom,
+                                       max_edits=best - 1))
+    return best, avg_ref_len
+
+def multi_ref_ter(hyp, refs, tercom=False):
+    """TER of hyp against several references, see multi_ref_ter_edits."""
+    e, avg_ref_len = multi_ref_ter_edits(hyp, refs, tercom)
+    if not avg_ref_len:
+        return 1.0 if e else 0.0
+    return e / avg_ref_len
+
+def corpus_multi_ref_ter(hyps, references, tercom=False):
+    """
+    Corpus TER, total edits over total average reference length, and an
+    array of the TER of each hypothesis, for a list of references per
+    hypothesis.
+    """
+    edits, ref_lengths = [], []
+    for hyp, refs in zip(hyps, references):
+        e, avg_ref_len = multi_ref_ter_edits(hyp, refs, tercom)
+        edits.append(e)
+        ref_lengths.append(avg_ref_len)
+    return edit_rate_scores(edits, ref_lengths)
+
+
+def padded_edit_distance(hyps, hyp_lengths, refs, ref_lengths):
+    """
+    Levenshtein distances of a batch of padded token id arrays.
+    hyps has shape (B, N) and refs shape (B, M); only the first hyp_lengths[b]
+    and ref_lengths[b] ids of row b are read. The DP table of every pair is
+    swept one anti-diagonal i + j = d at a time, each as a single NumPy step
+    over the whole batch, with cell (i, d - i) kept at index i.
+    """
+    batch, max_hyp_len = hyps.shape
+    max_ref_len = refs.shape[1]
+    hyp_lengths = np.asarray(hyp_lengths)
+    ref_lengths = np.asarray(ref_lengths)
+    big = np.iinfo(np.int32).max // 2
+    distances = np.zeros(batch, dtype=np.int32)
+    rows = np.arange(batch)
+    ends = hyp_lengths + ref_lengths
+    previous2 = np.full((batch, max_hyp_len + 1), big, dtype=np.int32)
+    previous = np.full((batch, max_hyp_len + 1), big, dtype=np.int32)
+    previous[:, 0] = 0
+    for d in range(1, max_hyp_len + max_ref_len + 1):
+        current = np.full((batch, max_hyp_len + 1), big, dtype=np.int32)
+        low, high = max(0, d - max_ref_len), min(max_hyp_len, d)
+        if low == 0:
+            current[:, 0] = d
+        if high == d:
+            current[:, d] = d
+        i = np.arange(max(low, 1), min(high, d - 1) + 1)
+        if len(i):
+            cost = hyps[:, i - 1] != refs[:, d - i - 1]
+            current[:, i] = np.minimum(
+                np.minimum(previous[:, i - 1], previous[:, i]) + 1,
+                previous2[:, i - 1] + cost)
+        done = ends == d
+        distances[done] = current[rows[done], hyp_lengths[done]]
+        previous2, previous = previous, current
+    return distances
+
+def batch_edit_distance(hyps, refs, batch_size=512):
+    """
+    Levenshtein distances of tokenized (hyp, ref) pairs.
+    Tokens are interned and pairs of similar total length are padded into
+    batches of batch_size for padded_edit_distance. Like zip, pairs stop at
+    the shorter of hyps and refs.
+    """
+    vocab = NgramVocabulary(check_collisions=False)
+    hyps, refs = hyps[:len(refs)], refs[:len(hyps)]
+    hyps = [vocab.encode(hyp) for hyp in hyps]
+    refs = [vocab.encode(ref) for ref in refs]
+    hyp_lengths = np.array([len(hyp) for hyp in hyps], dtype=np.int64)
+    ref_lengths = np.array([len(ref) for ref in refs], dtype=np.int64)
+    order = np.argsort(hyp_lengths + ref_lengths, kind='stable')
+    distances = np.zeros(len(hyps), dtype=np.int64)
+    for start in range(0, len(order), batch_size):
+        pairs = order[start:start + batch_size]
+        padded_hyps = np.zeros((len(pairs), max(hyp_lengths[pairs])),
+                               dtype=np.uint64)
+        padded_refs = np.zeros((len(pairs), max(ref_lengths[pairs])),
+                               dtype=np.uint64)
+        for row, pair in enumerate(pairs):
+            padded_hyps[row, :hyp_lengths[pair]] = hyps[pair]
+            padded_refs[row, :ref_lengths[pair]] = refs[pair]
+        distances[pairs] = padded_edit_distance(
+            padded_hyps, hyp_lengths[pairs], padded_refs, ref_lengths[pairs])
+    return distances
+
+def edit_rates(hyps, refs):
+    """
+    WER, or equally TER without shifts, of tokenized (hyp, ref) pairs.
+    Returns the corpus rate, total edits over total reference length, and an
+    array of the rate of each pair. An empty reference scores 1, or 0 against
+    an empty hypothesis.
+    """
+    distances = batch_edit_distance(hyps, refs)
+    return edit_rate_scores(distances, [len(ref) for ref in refs])
+
+
+def edit_rate_scores(edits, ref_lengths):
+    """
+    Corpus rate, total edits over total reference length, and array of the
+    rate of each segment, from edit counts and reference lengths.
+    """
+    edits = np.asarray(edits)
+    ref_lengths = np.asarray(ref_lengths[:len(edits)], dtype=float)
+    rates = np.where(ref_lengths > 0,
+                     edits / np.where(ref_lengths > 0, ref_lengths, 1),
+                     (edits > 0).astype(float))
+    if ref_lengths.sum() > 0:
+        corpus_rate = edits.sum() / ref_lengths.sum()
+    else:
+        corpus_rate = float(edits.sum() > 0)
+    return corpus_rate, rates
+
+
+def myers_ld(s, t):
+    """
+    Levenshtein distance of s and t by Myers' bit-vector algorithm, in
+    Hyyro's formulation for the global distance. One DP column of t is held
+    as bit vectors of its vertical +1/-1 deltas in Python ints, so each
+    element of s costs a few big-int operations on len(t) bits instead of
+    len(t) cell updates. Suited to long sequences of characters.
+    """
+    if not t:
+        return len(s)
+    mask = (1 << len(t)) - 1
+    last = 1 << (len(t) - 1)
+    # Bit k of peq[c] is set where t[k] == c.
+    peq = {}
+    for k, token in enumerate(t):
+        peq[token] = peq.get(token, 0) | (1 << k)
+    pv, mv, distance = mask, 0, len(t)
+    for token in s:
+        eq = peq.get(token, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & last:
+            distance += 1
+        elif mh & last:
+            distance -= 1
+        # The top row of the table grows by one per element of s.
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return distance
+
+def wer(hyp, ref):
+    """Word error rate of a tokenized hyp against ref."""
+    return edit_rate_scores([ld(hyp, ref)], [len(ref)])[0]
+
+def corpus_wer(hyps, refs, trace=False):
+    """
+    Corpus word error rate of tokenized (hyp, ref) pairs, total edits over
+    total reference length, and an array of the WER of each pair. With
+    trace=True, also returns the edit_trace of each pair, whose DP tables
+    then give the edits in place of the batched distance.
+    """
+    if not trace:
+        return edit_rates(hyps, refs)
+    traces = [edit_trace(hyp, ref) for hyp, ref in zip(hyps, refs)]
+    return edit_rate_scores([edits for edits, _, _ in traces],
+                            [len(ref) for ref in refs]) + (traces,)
+
+def cer(hyp, ref):
+    """Character error rate of a hyp string against a ref string."""
+    return edit_rate_scores([myers_ld(hyp, ref)], [len(ref)])[0]
+
+def corpus_cer(hyps, refs):
+    """
+    Corpus character error rate of (hyp, ref) strings, total edits over
+    total reference length in characters, and an array of the CER of each
+    pair.
+    """
+    edits = [myers_ld(hyp, ref) for hyp, ref in zip(hyps, refs)]
+    return edit_rate_scores(edits, [len(ref) for ref in refs])
 
-from nltk.translate.bleu_score import sentence_bleu
 
-def compute_scores(ref, hyp):
+def balanced_chunks(costs, num_chunks):
+    """
+    Split item indices into num_chunks chunks of about equal total cost,
+    greedily giving the costliest remaining item to the cheapest chunk.
+    Each chunk lists its indices in increasing order.
+    """
+    heap = [(0, k, []) for k in range(num_chunks)]
+    for index in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        total, k, chunk = heapq.heappop(heap)
+        chunk.append(index)
+        heapq.heappush(heap, (total + costs[index], k, chunk))
+    return [sorted(chunk) for _, _, chunk in sorted(heap, key=lambda c: c[1])
+            if chunk]
+
+def _ter_chunk(pairs, tercom=False, edits=False, trace=False):
+    if trace:
+        return [ter_edits(hyp, ref, tercom, trace=True) for hyp, ref in pairs]
+    score = ter_edits if edits else ter
+    return [score(hyp, ref, tercom) for hyp, ref in pairs]
+
+def parallel_ter(hyps, refs, processes=None, tercom=False, edits=False,
+                 trace=False):
+    """
+    TER of every (hyp, ref) pair, computed on a pool of processes, the
+    number of edits with edits=True, or what ter_edits returns with
+    trace=True.
+    The cost of a pair grows with the product of its lengths, so the pairs
+    are split into one chunk per process balanced on that product rather
+    than on the number of pairs. Scores are returned in the order of the
+    pairs.
+    """
+    pairs = list(zip(hyps, refs))
+    processes = processes or os.cpu_count() or 1
+    costs = [(len(hyp) + 1) * (len(ref) + 1) for hyp, ref in pairs]
+    chunks = balanced_chunks(costs, processes)
+    scores = [None] * len(pairs)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        results = pool.map(_ter_chunk, [[pairs[i] for i in chunk]
+                                        for chunk in chunks],
+                           [tercom] * len(chunks), [edits] * len(chunks),
+                           [trace] * len(chunks))
+        for chunk, chunk_scores in zip(chunks, results):
+            for i, score in zip(chunk, chunk_scores):
+                scores[i] = score
+    return scores
+
+def corpus_ter(hyps, refs, processes=1, tercom=False, trace=False):
+    """
+    Corpus TER, total edits over total reference length, and an array of the
+    TER of each (hyp, ref) pair. processes other than 1 runs parallel_ter,
+    None using one process per CPU. With trace=True, also returns the
+    ter_edits trace of each pair, for write_edit_traces.
+    """
+    if processes == 1:
+        results = [ter_edits(hyp, ref, tercom, trace)
+                   for hyp, ref in zip(hyps, refs)]
+    else:
+        results = parallel_ter(hyps, refs, processes, tercom, edits=True,
+                               trace=trace)
+    edits = [result[0] for result in results] if trace else results
+    scores = edit_rate_scores(edits, [len(ref) for ref in refs])
+    return scores + (results,) if trace else scores
+
+
+def compute_scores(ref, hyp, shifts=True, processes=1):
+    # nltk is slow to import and only needed here.
+    from nltk.translate.bleu_score import sentence_bleu
+
     splitted_ref = [r.split(' ') for r in ref]
     splitted_hyp = [h.split(' ') for h in hyp]
     
     blue_score = list(map(lambda x, y: sentence_bleu([x], y), splitted_ref,
                            splitted_hyp))
     
-    ter_score = list(map(lambda x, y: ter(x, y), splitted_ref,
-                           splitted_hyp))
+    if shifts and processes != 1:
+        # processes=None uses one process per CPU.
+        ter_score = parallel_ter(splitted_ref, splitted_hyp, processes)
+    elif shifts:
+        ter_score = list(map(lambda x, y: ter(x, y), splitted_ref,
+                               splitted_hyp))
+    else:
+        # Without shifts TER is an edit rate, computed for all pairs at once.
+        ter_score = edit_rates(splitted_ref, splitted_hyp)[1].tolist()
 
     return blue_score, ter_score
 